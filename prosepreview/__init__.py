@@ -1,10 +1,17 @@
 import abc
+import functools
+import itertools
+import os
 import re
-import shutil
 import subprocess
 import tempfile
 import typing
 
+try:
+    import pygit2
+except ImportError:
+    pygit2 = None
+
 
 class Chapter(typing.TypedDict):
     path: str
@@ -29,26 +36,27 @@ class Re:
     # DQ - Double quote
     # SQ - Single quote
 
-    unicode_double_quotes = re.compile(r'[“”]')
-    unicode_single_quotes = re.compile(r'[‘’]')
+    unicode_quotes = {
+        '“': '"',
+        '”': '"',
+        '‘': "'",
+        '’': "'",
+    }
 
     nonterminal_punc = ',:;'
     terminal_punc = '.?!'
+    punc_set = frozenset(nonterminal_punc + terminal_punc)
 
     multispace = re.compile(r'\s+')
 
+    # Any line that is empty or only whitespace
+    paragraph_sep = re.compile(r'\n\s*\n')
+
     word_sep = re.compile('|'.join([
         ' ',  # Space
         '(?<=[{0}])(?!\Z|\')'  # After NTP, not before EOS or SQ
     ]).format(nonterminal_punc))
 
-    line_sep = re.compile('|'.join([
-        r'(?<=")(?!\Z)',  # After DQ, not before EOS
-        r'(?<!\A)(?=")',  # Not after SOS, before DQ
-        r'(?<=[^.][{0}]|[{0}]\')'  # After TP not preceded by period, or after TP followed by SQ
-        r'(?![{0}_\d\']|\s*"|\Z)'  # Not before a TP, _, or \d, and not before WS preceding DQ, and not before EOS
-    ]).format(terminal_punc))
-
     italic_block = re.compile(r'_([^_]*)_')
 
     # Whitespace, quote, anything until the first (quote followed by whitespace)
@@ -56,7 +64,7 @@ class Re:
 
     double_quote_block = re.compile(r'"\n([^"]*)\n"')
 
-    latex_escape = re.compile(r'([#%&])')
+    latex_special = '#%&'
 
 
 class Text:
@@ -69,115 +77,148 @@ class Text:
         return self
 
     def resub(self, old, new) -> typing.Self:
-        self.contents = re.sub(old, new, self.contents)
+        if isinstance(old, re.Pattern):
+            self.contents = old.sub(new, self.contents)
+        else:
+            self.contents = re.sub(old, new, self.contents)
         return self
 
     def fix_input(self) -> typing.Self:
-        return self.resub(
-            Re.multispace, ' '
-        ).resub(
-            Re.unicode_double_quotes, '"'
-        ).resub(
-            Re.unicode_single_quotes, "'"
-        )
+        # str.replace returns the string without copying it if the character
+        # doesn't occur, so this is cheap for text without unicode quotes
+        # The text is kept as str rather than UTF-8 bytes: the quotes are
+        # multi-byte there, and rb'\s' wouldn't match non-ASCII whitespace
+        for old, new in Re.unicode_quotes.items():
+            self.sub(old, new)
+        return self.resub(Re.multispace, ' ')
 
 
 class TxtFormatter:
 
     def __init__(self, config: Config):
         self.config = config
+        self.columns = config['columns']
+        self.paragraph_break = ('',) * config['paragraph_spacing']
 
     @staticmethod
     def split_words(line: str) -> list[str]:
-        tokens = [w.strip() for w in re.split(Re.word_sep, line)]
-        for i, token in enumerate(tokens[1:], start=1):
-            if token in {*Re.nonterminal_punc, *Re.terminal_punc}:
-                tokens[i - 1] += token
-                tokens[i] = None
-        return [t for t in tokens if t is not None]
+        first, *rest = Re.word_sep.split(line)
+        words = [first.strip()]
+        for token in rest:
+            token = token.strip()
+            if token in Re.punc_set:
+                words[-1] += token
+            else:
+                words.append(token)
+        return words
 
     @staticmethod
     def split_lines(line: str) -> list[str]:
-        return [l.strip() for l in re.split(Re.line_sep, line)]
+        # The separators only ever occur next to a DQ, TP, or SQ, so rather than
+        # running a regex with lookarounds at every position, find those
+        # characters directly and check the neighbours of each one
+        end = len(line)
+        seps = set()
+
+        i = line.find('"')
+        while i != -1:
+            if i:
+                seps.add(i)  # Not after SOS, before DQ
+            if i + 1 < end:
+                seps.add(i + 1)  # After DQ, not before EOS
+            i = line.find('"', i + 1)
+
+        for char in Re.terminal_punc + "'":
+            i = line.find(char, 1)
+            while i != -1:
+                sep = i + 1
+                if char == "'":
+                    after_tp = line[i - 1] in Re.terminal_punc  # After TP followed by SQ
+                else:
+                    after_tp = line[i - 1] != '.'  # After TP not preceded by period
+                # Not before a TP, _, \d, or SQ, not before WS preceding DQ, and not before EOS
+                if after_tp and sep < end and not (
+                    (next_ := line[sep]) in Re.terminal_punc + "_'"
+                    or next_.isdecimal()
+                    or next_.isspace() and line.startswith('"', Re.multispace.match(line, sep).end())
+                ):
+                    seps.add(sep)
+                i = line.find(char, sep)
+
+        bounds = [0, *sorted(seps), end]
+        return [line[start:stop].strip() for start, stop in zip(bounds, bounds[1:])]
 
     @staticmethod
-    def take_paragraph(file_) -> typing.Iterator[str]:
-        while True:
-            line = file_.readline()
-            if not line:
-                raise EOFError
-            line = line.strip()
-            if line:
-                yield line
-                break
-
-        while line := file_.readline().strip():
-            yield line
+    def split_paragraphs(text: str) -> typing.Iterator[str]:
+        for paragraph in Re.paragraph_sep.split(text):
+            # Joins the lines of the paragraph with single spaces
+            paragraph = Text(paragraph).fix_input().contents.strip()
+            if paragraph:
+                yield paragraph
 
     def take_words(self, words: list[str]) -> tuple[list[str], list[str]]:
-        len_ = 0
+        # Loading a local is as cheap as loading a constant, so there is nothing
+        # to gain from generating a copy of this method with columns inlined
+        columns = self.columns
+        # Start at -1 so that the first word doesn't count a leading space
+        len_ = -1
         i = 0
         for word in words:
-            add_len = len(word) + bool(i)
-            if len_ + add_len <= self.config['columns']:
-                len_ += add_len
-                i += 1
-            else:
+            len_ += len(word) + 1
+            if len_ > columns:
                 break
+            i += 1
         if i == 0:
-            fragment = word[:self.config['columns']:]
-            words[0] = word[self.config['columns']:]
+            fragment = word[:columns:]
+            words[0] = word[columns:]
             return [fragment], words
         else:
             return words[:i], words[i:]
 
-    def format_paragraph(self, file_) -> typing.Iterator[str]:
-        lines = (Text(line).fix_input().contents for line in self.take_paragraph(file_))
-        lines = self.split_lines(' '.join(lines))
-        for line in lines:
+    def format_paragraph(self, paragraph: str) -> typing.Iterator[str]:
+        for line in self.split_lines(paragraph):
             words = self.split_words(line)
             while words:
                 line_fit, words = self.take_words(words)
                 yield ' '.join(line_fit)
 
-    def format_file(self, path) -> typing.Iterator[str]:
+    def format_lines(self, path) -> typing.Iterator[str]:
         with open(path) as f:
-            first_paragraph = True
-            while True:
-                first_line = True
-                lines = self.format_paragraph(f)
-                while True:
-                    try:
-                        line = next(lines)
-                    except StopIteration:
-                        break
-                    except EOFError:
-                        return
-                    else:
-                        assert len(line) <= self.config['columns']
-                        assert line == line.strip()
-                        if first_line and not first_paragraph:
-                            yield '\n' * self.config['paragraph_spacing']
-                        yield line + '\n'
-                        first_line = False
-                first_paragraph = False
+            text = f.read()
+        for i, paragraph in enumerate(self.split_paragraphs(text)):
+            if i:
+                yield from self.paragraph_break
+            for line in self.format_paragraph(paragraph):
+                assert len(line) <= self.columns
+                assert line == line.strip()
+                yield line
+
+    def format_file(self, path) -> typing.Iterator[str]:
+        # Interleave the line endings rather than concatenating one onto each line
+        return itertools.chain.from_iterable(zip(self.format_lines(path), itertools.repeat('\n')))
 
 
 class Txt2Tex(Text):
 
+    @staticmethod
+    def italicize(m: re.Match) -> str:
+        return '\\textit{' + m.group(1).replace('\n\n', '}\n\n\\textit{') + '}'
+
     def handle_italics(self) -> typing.Self:
-        i = 0
-        while (m := Re.italic_block.search(self.contents, i)) is not None:
-            before, after = self.contents[:m.start()], self.contents[m.end():]
-            content = '\\textit{' + m.group(1).replace('\n\n', '}\n\n\\textit{') + '}'
-            i += len(content)
-            self.contents = before + content + after
+        return self.resub(Re.italic_block, self.italicize)
+
+    def escape_latex(self) -> typing.Self:
+        # Much faster than a regex or str.translate for a few single characters
+        for char in Re.latex_special:
+            self.sub(char, '\\' + char)
         return self
 
     def texify(self) -> typing.Self:
-        return self.resub(
-            Re.latex_escape, r'\\\1'
-        ).sub(
+        # These passes can't be fused into a single alternation: each one sees
+        # the output of the previous ones. SQ blocks may span DQ blocks, the
+        # ''' fixup only exists once both quote passes have run, and italics
+        # must run last because _ counts as \w for the SQ lookarounds.
+        return self.escape_latex().sub(
             '--', '---'
         ).resub(
             Re.single_quote_block,
@@ -198,19 +239,58 @@ class GitStatus:
     def run(self, *cmd: str) -> str:
         return subprocess.check_output(cmd).decode()
 
-    def is_git_active(self):
+    def read_libgit2_status(self) -> tuple[str, bool] | None:
+        # Like a failing git status, anything libgit2 refuses to read (e.g. a
+        # bare repository, or one owned by another user) leaves git out entirely
         try:
-            return self.run('git', 'status')
+            path = pygit2.discover_repository(os.getcwd())
+            if path is None:
+                return None
+            repo = pygit2.Repository(path)
+            # Match what git status reports for a repository with no commits
+            checksum = '(initial)' if repo.head_is_unborn else str(repo.head.target)
+            # Don't rely on the default, which before pygit2 1.10 included
+            # ignored files such as the build outputs in .tex
+            changes = repo.status(ignored=False)
+        except pygit2.GitError:
+            return None
+        return checksum, bool(changes)
+
+    def read_git_status(self) -> tuple[str, bool] | None:
+        # A single call reports both the checksum of HEAD (as a header entry)
+        # and whether there are any changes (as the remaining entries)
+        try:
+            output = self.run('git', 'status', '--porcelain=v2', '--branch', '-z')
         except subprocess.CalledProcessError:
-            return False
+            return None
+        headers = {}
+        changes = []
+        for entry in filter(None, output.split('\0')):
+            if entry.startswith('# '):
+                key, _, value = entry[2:].partition(' ')
+                headers[key] = value
+            else:
+                changes.append(entry)
+        return headers['branch.oid'], bool(changes)
+
+    @functools.cached_property
+    def status(self) -> tuple[str, bool] | None:
+        # Reading the repository in-process avoids spawning git at all
+        if pygit2 is None:
+            return self.read_git_status()
         else:
-            return True
+            return self.read_libgit2_status()
+
+    def is_git_active(self) -> bool:
+        return self.status is not None
 
     def get_git_checksum(self) -> str:
-        return self.run('git', 'rev-parse', '@').strip()
+        checksum, _ = self.status
+        return checksum
 
     def get_git_dirtiness(self) -> bool:
-        return bool(self.run('git', 'status', '--porcelain').strip())
+        _, dirty = self.status
+        return dirty
 
     def __str__(self) -> str:
         checksum = self.get_git_checksum()
@@ -240,20 +320,40 @@ class TexCompiler(abc.ABC):
     def end(self, tag) -> str:
         return self.cmd('end', [tag])
 
+    def prefetch(self) -> None:
+        pass
+
     @abc.abstractmethod
     def compile(self) -> typing.Iterator[str]:
         raise NotImplementedError
 
 
 class TexChapter(TexCompiler):
+    chunk_size = 64 * 1024
 
     def __init__(self, config: Chapter):
         self.config = config
 
+    @property
+    def path(self) -> str:
+        return '../' + self.config['path']
+
+    def prefetch(self) -> None:
+        # Ask the kernel to start reading the whole file in the background,
+        # so that reads for all chapters are in flight at once instead of
+        # one at a time as each chapter is reached
+        if hasattr(os, 'posix_fadvise'):
+            fd = os.open(self.path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+
     def compile(self) -> typing.Iterator[str]:
         yield self.cmd('chapter', [] if (title := self.config['title']) is None else [title])
-        with open('../' + self.config['path']) as f:
-            yield from f
+        with open(self.path) as f:
+            while chunk := f.read(self.chunk_size):
+                yield chunk
 
 
 class TexPartBreak(TexCompiler):
@@ -281,9 +381,7 @@ class TexDoc(TexCompiler):
                 chapters.append(TexChapter(source))
         return chapters
 
-    def compile(self) -> typing.Iterator[str]:
-
-        chapters = self.load_chapters()
+    def compile_front_matter(self) -> typing.Iterator[str]:
 
         yield self.cmd('documentclass', ['book'])
 
@@ -325,14 +423,31 @@ class TexDoc(TexCompiler):
 
         yield self.cmd('tableofcontents')
 
+    def compile(self) -> typing.Iterator[str]:
+
+        chapters = self.load_chapters()
         for chapter in chapters:
-            yield from chapter.compile()
+            chapter.prefetch()
 
-        yield self.end('document')
+        yield from itertools.chain.from_iterable((
+            self.compile_front_matter(),
+            *(chapter.compile() for chapter in chapters),
+            [self.end('document')],
+        ))
 
 def atomic_write(lines: typing.Iterable[str], path) -> None:
-    temp = tempfile.mktemp()
-    with open(temp, 'x') as f:
-        for line in lines:
-            f.write(line)
-    shutil.move(temp, path)
+    # Create the temporary file next to the target so that the final rename
+    # never has to fall back to copying across filesystems
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+    try:
+        # mkstemp creates the file as 0600, but the result should get the
+        # same permissions as any other newly created file
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temp, 0o666 & ~umask)
+        with os.fdopen(fd, 'w') as f:
+            f.writelines(lines)
+        os.replace(temp, path)
+    except BaseException:
+        os.unlink(temp)
+        raise
@@ -15,4 +15,7 @@ setuptools.setup(
         ]
     },
     python_requires='>=3.11.1',
+    extras_require={
+        'git': ['pygit2>=1.10'],
+    },
 )